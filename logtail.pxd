@@ -0,0 +1,5 @@
+cimport cython
+
+@cython.locals(end=Py_ssize_t, start=Py_ssize_t, lines=Py_ssize_t, newline=Py_ssize_t,
+               pos=Py_ssize_t, line_end=Py_ssize_t, out=list)
+cpdef bytes truncate_lines(object data, Py_ssize_t max_lines, Py_ssize_t max_line_length, Py_ssize_t begin=*)
@@ -0,0 +1,52 @@
+r'''
+Tail of log files, working on bytes so that the dropped part is never decoded.
+
+>>> truncate_lines(b'first\nsecond line\r\nthird\n', 2, 4)
+b'seco\nthir'
+>>> truncate_lines(b'partial\nline 1\n\nline 3', 10, 100, begin=8)
+b'line 1\n\nline 3'
+>>> truncate_lines(b'', 10, 100)
+b''
+'''
+
+__all__ = ['truncate_lines']
+
+def truncate_lines(data, max_lines, max_line_length, begin=0):
+    '''Returns the last `max_lines` lines of `data[begin:]`, each cut to `max_line_length` bytes.
+
+    `data` is bytes or anything with the same `find`/`rfind`/slicing, e.g. mmap.mmap.
+
+    Lines are separated by b'\\n' (a trailing b'\\r' is dropped) and joined back with b'\\n'.'''
+    if max_lines <= 0:
+        return b''
+
+    end = len(data)
+    if end > begin and data[end - 1] == 10: # (b'\n' - it ends the last line, doesn't start another one)
+        end -= 1
+
+    # walk back over `max_lines` newlines
+    start = end
+    lines = 0
+    while lines < max_lines:
+        lines += 1
+        newline = data.rfind(b'\n', begin, start)
+        if newline < 0:
+            start = begin
+            break
+        start = newline
+    else:
+        start += 1
+
+    out = []
+    pos = start
+    while True:
+        newline = data.find(b'\n', pos, end)
+        line_end = end if newline < 0 else newline
+        if line_end > pos and data[line_end - 1] == 13: # (b'\r')
+            line_end -= 1
+        out.append(data[pos:min(line_end, pos + max_line_length)])
+        if newline < 0:
+            break
+        pos = newline + 1
+
+    return b'\n'.join(out)
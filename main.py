@@ -1,13 +1,16 @@
-from zima_core import Notebook
 import pathlib, argparse
-import zima_core
+
+# zima_core and zima_http pull in polars, duckdb, flask etc., so they are only imported
+# by the subcommands that need them
 
 def load_and_run_server(ns):
     import zima_http
+    from zima_core import Notebook
     notebook = Notebook(pathlib.Path(ns.notebook_file))
     zima_http.run_http_server(notebook, ns.port)
 
 def debug_run_cell(notebook_file, cell_id):
+    from zima_core import Notebook
     notebook = Notebook(pathlib.Path(notebook_file))
     thread = notebook.execute_cell(cell_id)
     thread.join()
@@ -33,6 +36,7 @@ def main():
     if ns.command == "run-server":
         load_and_run_server(ns)        
     elif ns.command == "internal-execute":
+        import zima_core
         zima_core.internal_execute(ns.payload_file, ns.output_file)
     elif ns.command == "debug-run-cell":
         debug_run_cell(ns.notebook_file, ns.cell_id)
@@ -0,0 +1,93 @@
+cimport cython
+
+cdef void* _thread_local_c
+
+cdef int _CLEAN
+cdef int _CHECK
+cdef int _DIRTY
+
+cdef class _thread_state:
+    cdef public object ref_enabled
+    cdef public bint immutable_ctx
+    cdef public object record_lookups
+    cdef public list pending_list
+    cdef public list set_freelist
+    cdef public list list_freelist
+    cdef public list spare_pending_list
+    cdef public object spare_queue
+    cdef public int transaction_depth
+
+cdef inline _thread_state _get_thread_local()
+cdef tuple _record_lookups(f)
+cdef _release_set(set s)
+
+cdef class _BaseRef:
+    cdef public set _rdepends
+    cdef public set _depends
+    cdef public int _height
+    cdef public bint _enabled
+    cdef public object _value
+    cdef public object _pending
+    cdef public int _state
+    cdef public set _observer_roots
+    cdef public bint _in_queue
+    cdef object __weakref__
+
+    cpdef _enable_internal(self)
+    cpdef _enable(self)
+    cpdef _disable(self)
+    cdef inline _add_rdepend(self, _BaseRef val)
+    cdef inline _remove_rdepend(self, _BaseRef val)
+    cdef _add_observer_roots(self, set roots)
+    cdef _recompute_observer_roots(self)
+    cpdef _set_depends(self, set new_depends)
+    cdef inline _set_pending(self, x)
+    cdef inline _take_pending(self)
+    cdef inline _record_read(self)
+    cdef _mark(self, int state)
+    cdef _update_if_necessary(self)
+    cdef _update(self)
+    cdef _pull(self)
+    cpdef _refresh(self)
+
+cdef class CustomRef(_BaseRef):
+    cdef public object _enable_callback
+    cdef public object _disable_callback
+    cdef public object _write_callback
+
+    cpdef _enable(self)
+    cpdef _disable(self)
+
+cdef class _OnceQueue:
+    cdef public list buckets
+    cdef public int min_height
+    cdef public int size
+
+    cpdef add(self, int priority, _BaseRef value)
+    cpdef object pop(self)
+
+cdef class VarRef(_BaseRef):
+    pass
+
+cdef class ConstRef(_BaseRef):
+    pass
+
+cdef class ReactiveRef(_BaseRef):
+    cdef public object _exception
+    cdef public object _refresh_f
+
+    cpdef _refresh(self)
+    cdef _refresh_from(self, f)
+
+cdef class _DictItemRef(ReactiveRef):
+    cdef public object _dict_ref
+    cdef public object _key
+    cdef public object _f
+
+    cpdef _refresh(self)
+
+cdef class Observer(_BaseRef):
+    cdef public object _callback
+    cdef public object _ref
+
+    cpdef _refresh(self)
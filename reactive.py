@@ -26,17 +26,132 @@
 1
 >>> z._height
 2
+
+>>> a = VarRef(1)
+>>> calls = []
+>>> parity = reactive(lambda: a.value % 2)
+>>> label = reactive(lambda: calls.append(1) or ('odd' if parity.value else 'even'))
+>>> label_observer = Observer(label)
+>>> n = len(calls)
+>>> a.value = 3
+>>> stabilise()
+>>> len(calls) - n # parity didn't change, so label is not recomputed
+0
+>>> a.value = 4
+>>> stabilise()
+>>> len(calls) - n
+1
+>>> label.value
+'even'
+
+Writes done in a `transaction` block are propagated together when it ends:
+
+>>> b = VarRef(1)
+>>> c = VarRef(2)
+>>> seen = []
+>>> s = reactive(lambda: b.value + c.value)
+>>> s_observer = Observer(s, lambda: seen.append(s.value))
+>>> with transaction():
+...     b.value = 10
+...     stabilise() # deferred until the outermost transaction ends
+...     c.value = 20
+>>> seen
+[30]
+
+An observer whose callback failed still sees later changes:
+
+>>> d = VarRef(0)
+>>> doubled = reactive(lambda: d.value * 2)
+>>> seen = []
+>>> def failing_once():
+...     seen.append(doubled.value)
+...     if len(seen) == 1:
+...         raise ValueError('callback failed')
+>>> doubled_observer = Observer(doubled, failing_once)
+>>> d.value = 1
+>>> stabilise()
+Traceback (most recent call last):
+  ...
+ValueError: callback failed
+>>> d.value = 2
+>>> stabilise()
+>>> seen
+[2, 4]
+
+A ref that starts being observed while a write is pending is still brought up to date:
+
+>>> flag = VarRef(False)
+>>> v = VarRef(0)
+>>> inner = reactive(lambda: v.value)
+>>> outer = reactive(lambda: inner.value if flag.value else -1)
+>>> flag.value = True
+>>> stabilise()
+>>> v.value = 5
+>>> outer_observer = Observer(outer)
+>>> stabilise()
+>>> outer.value, inner.value
+(5, 5)
+
+Reads between a write and `stabilise` get the old value, so observers don't miss the change:
+
+>>> v2 = VarRef(0)
+>>> inner2 = reactive(lambda: v2.value)
+>>> outer2 = reactive(lambda: inner2.value if flag.value else -1)
+>>> v2.value = 5
+>>> seen = []
+>>> outer2_observer = Observer(outer2, lambda: seen.append(outer2.value))
+>>> outer2.value
+0
+>>> stabilise()
+>>> seen
+[5]
+
+A closed observer is forgotten by the refs it observed:
+
+>>> f = VarRef(0)
+>>> f_plus = reactive(lambda: f.value + 1)
+>>> f_plus_observer = Observer(f_plus)
+>>> f._observer_roots == {f_plus_observer}
+True
+>>> f_plus_observer.close()
+>>> f._observer_roots, f_plus._observer_roots
+(set(), set())
+
+Observers that were still queued behind the failed one are notified by the next change:
+
+>>> e = VarRef(0)
+>>> e2 = reactive(lambda: e.value * 2)
+>>> e4 = reactive(lambda: e2.value * 2)
+>>> seen = []
+>>> def failing_once():
+...     seen.append(e2.value)
+...     if len(seen) == 1:
+...         raise ValueError('callback failed')
+>>> e2_observer = Observer(e2, failing_once)
+>>> e4_observer = Observer(e4, lambda: seen.append(e4.value))
+>>> e.value = 1
+>>> stabilise()
+Traceback (most recent call last):
+  ...
+ValueError: callback failed
+>>> e.value = 2
+>>> stabilise()
+>>> seen
+[2, 4, 8]
 '''
 
 from typing import *
-import threading, weakref, functools, collections, heapq
+import threading, weakref, functools, collections, logging, contextlib
 from abc import ABCMeta, abstractproperty
+
+_log = logging.getLogger(__name__)
+
 try:
     import cython
 except ImportError:
     from . import fake_cython as cython
 
-__all__ = ['reactive', 'VarRef', 'stabilise', 'Ref', 'Observer', 'reactive_dict_map', 'reactive_property', 'const_ref']
+__all__ = ['reactive', 'VarRef', 'stabilise', 'Ref', 'Observer', 'reactive_dict_map', 'reactive_property', 'const_ref', 'transaction']
 
 T = TypeVar('T')
 
@@ -52,16 +167,34 @@ def _get_thread_local():
     else:
         return _thread_local # type: ignore
 
-_set_vars = {}
+# marks `_BaseRef._pending` as not written since the last `stabilise`
+_UNSET = object()
+
+# `_BaseRef._state`: CHECK - some transitive dependency changed, DIRTY - a direct dependency changed
+_CLEAN = 0
+_CHECK = 1
+_DIRTY = 2
 
 def init_thread_local():
     if cython.compiled:
         global _thread_local_c
         _thread_local.state = _thread_state()
         _thread_local_c = cython.cast(cython.p_void, _thread_local.state) # type: ignore
-    _get_thread_local().ref_enabled = None
-    _get_thread_local().immutable_ctx = False
-    _get_thread_local().record_lookups = None
+    ts = _get_thread_local()
+    ts.ref_enabled = None
+    ts.immutable_ctx = False
+    ts.record_lookups = None
+    # refs written since the last `stabilise` (value is kept in `ref._pending`)
+    ts.pending_list = []
+    # cleared sets for `_record_lookups`, so that recomputing a ref does not allocate one
+    ts.set_freelist = []
+    # same for the `ref_enabled` lists of `_update`
+    ts.list_freelist = []
+    # `stabilise` state kept for the next call (None while a call is using it)
+    ts.spare_pending_list = []
+    ts.spare_queue = None
+    # number of `transaction` blocks we are in
+    ts.transaction_depth = 0
 
 init_thread_local()
 
@@ -75,25 +208,40 @@ class Ref(Generic[T]):
         return isinstance(value, _BaseRef)
 
 class _BaseRef:
+    __slots__ = ('_rdepends', '_depends', '_height', '_enabled', '_value', '_pending',
+                 '_state', '_observer_roots', '_in_queue', '__weakref__')
+
     def __init__(self):
         self._rdepends = set()
         self._depends = set()
         self._height = 0
         self._enabled = False
+        self._pending = _UNSET
+        self._state = _CLEAN
+        self._in_queue = False
+        # Observers which (transitively) depend on us - these are refreshed when we change
+        self._observer_roots = set()
 
-    @cython.locals(d='_BaseRef')
+    @cython.locals(d='_BaseRef', height=cython.int)
     def _enable_internal(self):
         self._enabled = True
         for d in self._depends:
             # We start depending on `d`. This might enable `d` and change its height.
-            d.__add_rdepend(self)
-            self._height = max(self._height, d._height + 1)
+            d._add_rdepend(self)
+        # (heights are only final once all of them are enabled)
+        height = 0
+        for d in self._depends:
+            if d._height >= height:
+                height = d._height + 1
+        self._height = height
 
     def _enable(self):
-        print('enable', self)
+        if _log.isEnabledFor(logging.DEBUG): _log.debug('enable %r', self)
         assert not self._enabled
         ref_enabled = _get_thread_local().ref_enabled
         if ref_enabled is not None: ref_enabled.append(self)
+        # we were not tracking changes while disabled, recompute on the next read
+        else: self._mark(_DIRTY)
 
         self._enable_internal()
 
@@ -101,34 +249,147 @@ class _BaseRef:
     def _disable(self):
         self._enabled = False
         for d in self._depends:
-            d.__remove_rdepend(self)
+            d._remove_rdepend(self)
+        # no longer observed (`_add_rdepend` sets them again when we are enabled)
+        self._observer_roots = set()
 
-    def __add_rdepend(self, val):
+    @cython.locals(val='_BaseRef')
+    def _add_rdepend(self, val):
         # `val` starts depending on us
         enabling = len(self._rdepends) == 0
         self._rdepends.add(val)
         if enabling:
+            self._observer_roots = set(val._observer_roots)
             self._enable()
+        else:
+            self._add_observer_roots(val._observer_roots)
 
-    def __remove_rdepend(self, val):
+    def _remove_rdepend(self, val):
         self._rdepends.remove(val)
         if len(self._rdepends) == 0:
             self._disable()
+        else:
+            self._recompute_observer_roots()
 
+    @cython.locals(d='_BaseRef')
+    def _add_observer_roots(self, roots):
+        if not roots <= self._observer_roots:
+            self._observer_roots |= roots
+            for d in self._depends:
+                d._add_observer_roots(roots)
+
+    @cython.locals(d='_BaseRef', r='_BaseRef')
+    def _recompute_observer_roots(self):
+        roots = set()
+        for r in self._rdepends:
+            roots |= r._observer_roots
+        if roots != self._observer_roots:
+            self._observer_roots = roots
+            for d in self._depends:
+                d._recompute_observer_roots()
+
+    @cython.locals(d='_BaseRef')
     def _set_depends(self, new_depends):
-        print('new deps', self, new_depends)
-        # TODO: rewrite to only enable/disable changed dependencies
-        if self._depends != new_depends:
-            enabled = self._enabled
-            if enabled: self._disable()
+        if _log.isEnabledFor(logging.DEBUG): _log.debug('new deps %r %r', self, new_depends)
+        if self._depends == new_depends:
+            _release_set(new_depends)
+        else:
+            old_depends = self._depends
             self._depends = new_depends
-            if enabled: self._enable_internal()
+            if self._enabled:
+                # add first, so that refs reachable via both old and new dependencies stay enabled
+                for d in new_depends - old_depends:
+                    d._add_rdepend(self)
+                for d in old_depends - new_depends:
+                    d._remove_rdepend(self)
+                self._height = 0
+                for d in new_depends:
+                    self._height = max(self._height, d._height + 1)
+            _release_set(old_depends)
 
     def _record_read(self):
         record_lookups = _get_thread_local().record_lookups
         if record_lookups is not None:
             record_lookups.add(self)
 
+    def _set_pending(self, x):
+        if self._pending is _UNSET:
+            _get_thread_local().pending_list.append(self)
+        self._pending = x
+
+    def _take_pending(self):
+        if self._pending is not _UNSET:
+            self._value = self._pending
+            self._pending = _UNSET
+
+    @cython.locals(r='_BaseRef')
+    def _mark(self, state):
+        if self._state < state:
+            was_clean = self._state == _CLEAN
+            self._state = state
+            if was_clean:
+                for r in self._rdepends:
+                    r._mark(_CHECK)
+
+    @cython.locals(d='_BaseRef')
+    def _update_if_necessary(self):
+        # (`_update` can leave us CHECK or DIRTY again, see there)
+        while self._state != _CLEAN:
+            if self._state == _CHECK:
+                # only recompute if some dependency really changed (this marks us DIRTY)
+                for d in self._depends:
+                    d._update_if_necessary()
+                    if self._state == _DIRTY:
+                        break
+                else:
+                    self._state = _CLEAN
+            if self._state == _DIRTY:
+                self._update()
+
+    @cython.locals(d='_BaseRef', r='_BaseRef', ts=_thread_state)
+    def _update(self):
+        old_value = self._value
+        ts = _get_thread_local()
+        enabled_ref: list = ts.list_freelist.pop() if ts.list_freelist else []
+        ref_enabled_prev = ts.ref_enabled
+        ts.ref_enabled = enabled_ref
+        try:
+            self._refresh()
+        finally:
+            ts.ref_enabled = ref_enabled_prev
+            # dependencies updated while we were reading them don't count
+            # (also if `_refresh` failed - a ref left DIRTY would never be marked again)
+            self._state = _CLEAN
+
+        # Refs enabled by `_refresh` were not tracked until now, so their values may be stale.
+        # If any of them changes, this marks us DIRTY (if we read it) or CHECK (if the change
+        # reaches us through other refs) again, and `_update_if_necessary` goes on until we
+        # are CLEAN.
+        for d in enabled_ref:
+            d._state = _DIRTY
+        for d in enabled_ref:
+            d._update_if_necessary()
+        enabled_ref.clear()
+        ts.list_freelist.append(enabled_ref)
+
+        if old_value != self._value:
+            for r in self._rdepends:
+                r._mark(_DIRTY)
+
+    @cython.locals(ts=_thread_state)
+    def _pull(self):
+        # called from `value` getters, possibly in the middle of another ref's evaluation
+        ts = _get_thread_local()
+        record_lookups_prev = ts.record_lookups
+        immutable_ctx_prev = ts.immutable_ctx
+        ts.record_lookups = None
+        ts.immutable_ctx = False
+        try:
+            self._update_if_necessary()
+        finally:
+            ts.record_lookups = record_lookups_prev
+            ts.immutable_ctx = immutable_ctx_prev
+
     def _refresh(self):
         pass
 
@@ -136,6 +397,8 @@ class _BaseRef:
         return reactive(lambda: f(self.value)) # type: ignore
 
 class CustomRef(_BaseRef):
+    __slots__ = ('_enable_callback', '_disable_callback', '_write_callback')
+
     def __init__(self, initial_value, write_callback, enable_callback=None, disable_callback=None,
                  _allow_in_immutable_ctx=False):
         super().__init__()
@@ -158,7 +421,10 @@ class CustomRef(_BaseRef):
 
     @property
     def value(self):
-        self._record_read()
+        # `_record_read`, inlined
+        record_lookups = _get_thread_local().record_lookups
+        if record_lookups is not None:
+            record_lookups.add(self)
         return self._value
 
     @value.setter
@@ -175,89 +441,116 @@ class CustomRef(_BaseRef):
 
     def change_value(self, x):
         assert not _get_thread_local().immutable_ctx
-        _set_vars[self] = x
-
-    def _refresh(self):
-        if self in _set_vars:
-            self._value = _set_vars[self]
+        self._set_pending(x)
 
     def __repr__(self):
         return 'CustomRef(%s, writable=%s)' % (self._value, self.is_writable)
 
-class _QueueItem:
-    priority: int
-    value: object
-
-    def __lt__(self, other: '_QueueItem'):
-        return self.priority < other.priority
-
 class _OnceQueue:
     '''
+    Queue of refs ordered by height (small integers), so it's kept as a list of buckets.
+
     >>> x = _OnceQueue()
-    >>> x.add(2, "foo", False)
-    >>> x.add(2, "foo", False)
-    >>> x.add(1, "bar", False)
+    >>> foo = VarRef("foo")
+    >>> bar = VarRef("bar")
+    >>> x.add(2, foo)
+    >>> x.add(2, foo)
+    >>> x.add(1, bar)
     >>> assert x
     >>> x.pop()
-    'bar'
+    VarRef(bar)
     >>> x.pop()
-    'foo'
+    VarRef(foo)
     >>> assert not x
     '''
+    __slots__ = ('buckets', 'min_height', 'size')
 
     def __init__(self):
-        self.queue: list = []
-        self.added = set()
-
-    def add(self, priority, value, force):
-        if force or value not in self.added:
-            item = _QueueItem()
-            item.value = value
-            item.priority = priority
-            heapq.heappush(self.queue, item)
-            self.added.add(value)
-
+        self.buckets: list = []
+        self.min_height = 0
+        self.size = 0
+
+    @cython.locals(value='_BaseRef')
+    def add(self, priority, value):
+        if value._in_queue:
+            return
+        while len(self.buckets) <= priority:
+            self.buckets.append([])
+        self.buckets[priority].append(value)
+        value._in_queue = True
+        self.size += 1
+        if priority < self.min_height:
+            self.min_height = priority
+
+    @cython.locals(value='_BaseRef')
     def pop(self):
-        item: _QueueItem = heapq.heappop(self.queue)
-        return item.value
+        while not self.buckets[self.min_height]:
+            self.min_height += 1
+        value = self.buckets[self.min_height].pop()
+        value._in_queue = False
+        self.size -= 1
+        return value
 
     def __bool__(self):
-        return bool(self.queue)
+        return self.size > 0
 
-@cython.locals(x=_BaseRef, item=_BaseRef)
+@cython.locals(queue=_OnceQueue, x=_BaseRef, r=_BaseRef, ts=_thread_state)
 def stabilise():
-    # zielmicha:
-    # This is extremly tricky. At some point I should write a formal proof of its behaviour.
-    # (good randomized test would be even better)
-    enabled_ref: list = []
-    _get_thread_local().ref_enabled = enabled_ref
-
-    queue = _OnceQueue()
-    for x in _set_vars: queue.add(x._height, x, force=False)
-
-    counter = 0
+    # Written refs mark their dependents DIRTY (and everything above CHECK), then only the
+    # observers that can see the change are pulled (lowest first). Intermediate refs are
+    # recomputed on demand, and only if one of their inputs really changed.
+
+    # writes done during this call (e.g. from observer callbacks) are left for the next one
+    ts = _get_thread_local()
+    pending_list: list = ts.pending_list
+    if not pending_list or ts.transaction_depth > 0:
+        return
+    # (the spare objects are missing if this is a nested call, e.g. from an observer callback)
+    ts.pending_list = ts.spare_pending_list if ts.spare_pending_list is not None else []
+    ts.spare_pending_list = None
+    queue = ts.spare_queue if ts.spare_queue is not None else _OnceQueue()
+    ts.spare_queue = None
 
-    while queue:
-        counter += 1
-        if counter > 10000: raise Exception('too many stabilise iterations')
-        item = queue.pop()
-        old_value = item._value
-        item._refresh()
-
-        if enabled_ref:
-            for x in enabled_ref:
-                queue.add(x._height, x, force=False)
-            enabled_ref[:] = []
-            queue.add(item._height, item, force=True)
-
-        if old_value != item._value:
-            for x in item._rdepends:
-                queue.add(x._height, x, force=False)
-
-    _get_thread_local().ref_enabled = None
-    _set_vars.clear()
+    try:
+        for x in pending_list:
+            # (until now every reader got the old value, which is what the observers saw)
+            old_value = x._value
+            x._take_pending()
+            if old_value != x._value:
+                for r in x._rdepends:
+                    r._mark(_DIRTY)
+                for r in x._observer_roots:
+                    queue.add(r._height, r)
+
+        while queue:
+            x = queue.pop()
+            x._update_if_necessary()
+    except:
+        # after a failed callback the remaining observers are dropped (`_in_queue` must be reset,
+        # so that later writes queue them again)
+        while queue:
+            queue.pop()
+        raise
+    finally:
+        pending_list.clear()
+        ts.spare_pending_list = pending_list
+        ts.spare_queue = queue
+
+@contextlib.contextmanager
+def transaction():
+    # `stabilise` calls inside the block do nothing, there is one when the outermost block exits
+    ts = _get_thread_local()
+    ts.transaction_depth += 1
+    try:
+        yield
+    finally:
+        ts.transaction_depth -= 1
+        if ts.transaction_depth == 0:
+            stabilise()
 
 class VarRef(_BaseRef):
+    __slots__ = ()
+
     def __init__(self, value):
         super().__init__()
         # it's too easy to cause infinite loops in `stabilise` by making new VarRefs in reactive contexts
@@ -266,34 +559,68 @@ class VarRef(_BaseRef):
 
     @property
     def value(self):
-        self._record_read()
+        # `_record_read`, inlined
+        record_lookups = _get_thread_local().record_lookups
+        if record_lookups is not None:
+            record_lookups.add(self)
         return self._value
 
     @value.setter
     def value(self, x):
         assert not _get_thread_local().immutable_ctx
-        _set_vars[self] = x
+        self._set_pending(x)
 
     @property
     def is_writable(self):
         return True
 
-    def _refresh(self):
-        if self in _set_vars:
-            self._value = _set_vars[self]
-
     def __repr__(self):
         return 'VarRef(%s)' % (self._value)
 
+class ConstRef(_BaseRef):
+    '''
+    >>> const_ref(5) is const_ref(5)
+    True
+    >>> const_ref([]) is const_ref([])
+    False
+    >>> const_ref(1) is const_ref(True), const_ref((1,)) is const_ref((True,))
+    (False, False)
+    >>> reactive(lambda: 5)
+    ConstRef(5)
+    '''
+    __slots__ = ()
+
+    def __init__(self, value):
+        super().__init__()
+        self._value = value
+
+    @property
+    def value(self):
+        # nothing to depend on - a constant never changes
+        return self._value
+
+    @property
+    def is_writable(self):
+        return False
+
+    def __repr__(self):
+        return 'ConstRef(%r)' % (self._value, )
+
 class ReactiveRef(_BaseRef):
+    __slots__ = ('_exception', '_refresh_f')
+
     def __init__(self, refresh_f):
         super().__init__()
         self._exception = None
+        # called with its reads recorded as our dependencies
         self._refresh_f = refresh_f
         self._refresh()
 
     def _refresh(self):
-        self._exception, self._value, new_depends = self._refresh_f()
+        self._refresh_from(self._refresh_f)
+
+    def _refresh_from(self, f):
+        self._exception, self._value, new_depends = _record_lookups(f)
         if self._exception is not None:
             self._value = object() # unique value every time
 
@@ -301,6 +628,8 @@ class ReactiveRef(_BaseRef):
 
     @property
     def value(self):
+        if self._state != _CLEAN:
+            self._pull()
         self._record_read()
         if self._exception is not None:
             raise self._exception
@@ -320,14 +649,21 @@ class ReactiveRef(_BaseRef):
         return 'ReactiveRef(%x %s)' % (id(self), v)
 
 class Observer(_BaseRef):
+    __slots__ = ('_callback', '_ref')
+
+    @cython.locals(ref='_BaseRef')
     def __init__(self, ref, callback=lambda: None):
         super().__init__()
         assert isinstance(ref, _BaseRef)
         self._callback = callback
         self._depends = {ref}
         self._ref = ref
+        self._observer_roots = {self}
         self._enable()
-        self._value = None
+        ref._pull()
+        self._state = _CLEAN
+        # last value of `ref` we have seen
+        self._value = ref._value
 
     def __enter__(self):
         pass
@@ -338,15 +674,35 @@ class Observer(_BaseRef):
     def close(self):
         self._disable()
 
+    @cython.locals(ref='_BaseRef')
     def _refresh(self):
-        self._callback()
+        ref = self._ref
+        ref._update_if_necessary()
+        if ref._value != self._value:
+            self._value = ref._value
+            self._callback()
 
     def __repr__(self):
         return '<Observer of %r>' % self._ref
 
+_const_refs: weakref.WeakValueDictionary = weakref.WeakValueDictionary()
+
+# Only values of these types are shared, as their equality implies they behave the same.
+# (not containers - (1,) == (True,) - and not floats, because of -0.0 == 0.0)
+_SHARED_CONST_TYPES = frozenset([int, bool, str, bytes, type(None)])
+
 def const_ref(value):
-    # TODO: opt
-    return reactive(lambda: value)
+    value_type = type(value)
+    if value_type not in _SHARED_CONST_TYPES:
+        return ConstRef(value)
+
+    # type is a part of the key, so that e.g. 1 and True are not shared
+    key = (value_type, value)
+    r = _const_refs.get(key)
+    if r is None:
+        r = ConstRef(value)
+        _const_refs[key] = r
+    return r
 
 def reactive_property(f):
     def wrapper(self):
@@ -360,24 +716,86 @@ def reactive_property(f):
     return property(wrapper)
 
 
+class _DictItemRef(ReactiveRef):
+    '''
+    `f(dict_ref.value[key])`, without allocating a closure for every key.
+
+    It's freed as soon as it's not used (it isn't a part of a reference cycle):
+
+    >>> import gc
+    >>> gc.disable()
+    >>> item = _DictItemRef(VarRef({'a': 1}), 'a', str)
+    >>> item.value
+    '1'
+    >>> item_weak = weakref.ref(item)
+    >>> del item
+    >>> item_weak() is None
+    True
+    >>> gc.enable()
+    '''
+    __slots__ = ('_dict_ref', '_key', '_f')
+
+    def __init__(self, dict_ref, key, f):
+        self._dict_ref = dict_ref
+        self._key = key
+        self._f = f
+        # (`_refresh` is overridden - storing the bound `self._get` would make a reference cycle)
+        super().__init__(None)
+
+    def _refresh(self):
+        self._refresh_from(self._get)
+
+    def _get(self):
+        return self._f(self._dict_ref.value[self._key])
+
+class _LruRefs:
+    '''
+    Keeps `maxsize` most recently used refs.
+
+    An evicted ref that is still enabled stays alive through its rdepends, only
+    the cache entry is dropped (and a later lookup creates a new ref).
+
+    >>> c = _LruRefs(2)
+    >>> c['a'] = const_ref('a'); c['b'] = const_ref('b')
+    >>> c.get('a')
+    ConstRef('a')
+    >>> c['c'] = const_ref('c')
+    >>> c.get('b') is None, list(c._refs)
+    (True, ['a', 'c'])
+    '''
+    def __init__(self, maxsize):
+        self._maxsize = maxsize
+        self._refs: collections.OrderedDict = collections.OrderedDict()
+
+    def get(self, key):
+        r = self._refs.get(key)
+        if r is not None:
+            self._refs.move_to_end(key)
+        return r
+
+    def __setitem__(self, key, r):
+        self._refs[key] = r
+        if len(self._refs) > self._maxsize:
+            self._refs.popitem(last=False)
+
+def _make_ref_cache(maxsize):
+    # maxsize=None keeps refs only as long as something else references them
+    if maxsize is None:
+        return weakref.WeakValueDictionary()
+    return _LruRefs(maxsize)
+
 class ReactiveDictMap:
     # If items would not depend on self.dict_ref we could avoid loops in many cases.
     # Then only KeyError needs to be handled specially.
-    def __init__(self, dict_ref, f):
+    def __init__(self, dict_ref, f, maxsize=1024):
         self.dict_ref = dict_ref
         self.f = f
-        # zielmicha: Is WeakValueDictionary actually safe here?
-        self._refs: weakref.WeakValueDictionary = weakref.WeakValueDictionary()
-        #self._refs = {}
+        self._refs = _make_ref_cache(maxsize)
 
     def __getitem__(self, key):
         r = self._refs.get(key)
         if not r:
-            def get():
-                res = self.dict_ref.value[key]
-                return self.f(res)
-
-            r = reactive(get)
+            r = _DictItemRef(self.dict_ref, key, self.f)
             self._refs[key] = r
 
         return r
@@ -388,14 +806,13 @@ class ReactiveDictMap:
     def __iter__(self):
         return iter(self.keys())
 
-def reactive_dict_map(f: Callable, ref: _BaseRef):
-    return ReactiveDictMap(ref, f)
+def reactive_dict_map(f: Callable, ref: _BaseRef, maxsize: Optional[int] = 1024):
+    return ReactiveDictMap(ref, f, maxsize)
 
 class ReactiveCache:
-    def __init__(self, f):
+    def __init__(self, f, maxsize=1024):
         self.f = f
-        # should we use disable to remove keys instead (as it's more deterministic?)
-        self._refs: weakref.WeakValueDictionary = weakref.WeakValueDictionary()
+        self._refs = _make_ref_cache(maxsize)
 
     def __call__(self, *key):
         r = self._refs.get(key)
@@ -405,15 +822,18 @@ class ReactiveCache:
 
         return r.value
 
-def reactive_cache(f: Callable):
-    return ReactiveCache(f)
+def reactive_cache(f: Callable, maxsize: Optional[int] = 1024):
+    return ReactiveCache(f, maxsize)
 
+@cython.locals(ts=_thread_state)
 def _record_lookups(f):
-    record_lookups_prev = _get_thread_local().record_lookups
-    immutable_ctx_prev = _get_thread_local().immutable_ctx
-    record_lookups: Set[Any] = set()
-    _get_thread_local().record_lookups = record_lookups
-    _get_thread_local().immutable_ctx = True
+    ts = _get_thread_local()
+    record_lookups_prev = ts.record_lookups
+    immutable_ctx_prev = ts.immutable_ctx
+    freelist: list = ts.set_freelist
+    record_lookups: Set[Any] = freelist.pop() if freelist else set()
+    ts.record_lookups = record_lookups
+    ts.immutable_ctx = True
     exception = None
     result = None
     try:
@@ -421,11 +841,22 @@ def _record_lookups(f):
     except Exception as exc:
         exception = exc
     finally:
-        _get_thread_local().record_lookups = record_lookups_prev
-        _get_thread_local().immutable_ctx = immutable_ctx_prev
+        ts.record_lookups = record_lookups_prev
+        ts.immutable_ctx = immutable_ctx_prev
 
     return exception, result, record_lookups
 
+@cython.locals(ts=_thread_state)
+def _release_set(s):
+    # `s` is no longer referenced by anyone
+    ts = _get_thread_local()
+    if len(ts.set_freelist) < 64:
+        s.clear()
+        ts.set_freelist.append(s)
+
 def reactive(f):
-    r = ReactiveRef(functools.partial(_record_lookups, f))
+    r = ReactiveRef(f)
+    if r._exception is None and not r._depends:
+        # `f` read no refs, so nothing can ever make it recompute
+        return ConstRef(r._value)
     return r
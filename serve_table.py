@@ -1,16 +1,50 @@
-from flask import Flask, render_template, request, jsonify, send_from_directory
-import polars as pl, pathlib
+from flask import Flask, Response, render_template, request, jsonify, send_from_directory
+import polars as pl, pathlib, functools, os
+
+@functools.lru_cache(maxsize=64)
+def _schema(path, mtime):
+    # only reads the parquet footer; `mtime` is here to invalidate the cache
+    return pl.scan_parquet(path).collect_schema()
+
+@functools.lru_cache(maxsize=64)
+def _row_count(path, mtime):
+    # also answered from the parquet metadata
+    return pl.scan_parquet(path).select(pl.len()).collect().item()
+
+_INTEGER_CHARS = frozenset('-0123456789')
+
+def search_expr(schema, search_value):
+    # true for rows where any column contains `search_value` (as a string)
+    could_be_integer = set(search_value) <= _INTEGER_CHARS
+    exprs = []
+    for col, dtype in schema.items():
+        if dtype.is_integer() and not could_be_integer:
+            continue
+        expr = pl.col(col) if dtype == pl.Utf8 else pl.col(col).cast(pl.Utf8)
+        exprs.append(expr.str.contains(search_value, literal=True, strict=False))
+
+    return pl.any_horizontal(exprs) if exprs else pl.lit(False)
+
+def install(app, get_filename, decorator=lambda f: f, pure_get_filename=False):
+    # If `get_filename` always maps the same arguments to the same file, it is only called
+    # once for each distinct query string.
+    if pure_get_filename:
+        cached_get_filename = functools.lru_cache(maxsize=64)(
+            lambda args: get_filename(dict(args)))
+        resolve_filename = lambda args: cached_get_filename(frozenset(args.items()))
+    else:
+        resolve_filename = get_filename
 
-def install(app, get_filename, decorator=lambda f: f):
     @app.route('/data', methods=['POST'])
     @decorator
     def data():
-        parquet_file_path = get_filename(request.args)
+        parquet_file_path = resolve_filename(request.args)
+        mtime = os.path.getmtime(parquet_file_path)
+        schema = _schema(parquet_file_path, mtime)
+        columns = schema.names()
         # Get DataTables parameters from the request
     
         if request.values.get('get-columns'):
-            df_sample = pl.read_parquet(parquet_file_path, n_rows=1)
-            columns = df_sample.columns
             return jsonify(columns)
         
         draw = int(request.values.get('draw', 1))
@@ -22,10 +56,6 @@ def install(app, get_filename, decorator=lambda f: f):
         order_column_index_str = request.values.get('order[0][column]')
         order_direction = request.values.get('order[0][dir]', 'asc')
     
-        # Fetch columns dynamically
-        df_sample = pl.read_parquet(parquet_file_path, n_rows=1)
-        columns = df_sample.columns
-    
         order_column = None
         if order_column_index_str:
             order_column_index = int(order_column_index_str)
@@ -35,43 +65,36 @@ def install(app, get_filename, decorator=lambda f: f):
         # Build the lazy DataFrame
         df_lazy = pl.scan_parquet(parquet_file_path)
     
-        # Total number of records before filtering
-        total_records = df_lazy.select(pl.count()).collect().item()
-    
-        
         # Apply global search filter if provided
         if search_value:
-            # Build a combined filter expression for all columns
-            filter_expr = pl.lit(False)
-            for col in columns:
-                expr = pl.col(col).cast(pl.Utf8).str.contains(search_value, literal=True, strict=False)
-                filter_expr = filter_expr | expr
-            df_lazy = df_lazy.filter(filter_expr)
+            df_lazy = df_lazy.filter(search_expr(schema, search_value))
     
-        # Total number of records after filtering
-        records_filtered = df_lazy.select(pl.count()).collect().item()
-    
-        # Apply ordering
+        # Apply ordering (with the slice below, polars can do a top-k instead of a full sort).
+        # Nulls are first when ascending and last when descending, as with sort + reverse.
+        df_sorted = df_lazy
         if order_column:
-            df_lazy = df_lazy.sort(order_column)
-            if (order_direction == 'desc'):
-                df_lazy = df_lazy.reverse()
-    
-        # Apply pagination
-        df_page = df_lazy.slice(start, length).collect()
+            descending = order_direction == 'desc'
+            df_sorted = df_sorted.sort(order_column, descending=descending, nulls_last=descending)
     
-        # Convert DataFrame to list of dicts
-        data = df_page.to_dicts()
-    
-        # Prepare the response in DataTables format
-        response = {
-            'draw': draw,
-            'recordsTotal': total_records,
-            'recordsFiltered': records_filtered,
-            'data': data,
-        }
-    
-        return jsonify(response)
+        # The total only changes with the file. Without a search the filtered count is the
+        # same, otherwise it is computed together with the page so that the scan is shared.
+        total_records = _row_count(parquet_file_path, mtime)
+        if search_value:
+            df_filtered, df_page = pl.collect_all([
+                df_lazy.select(pl.len()),
+                df_sorted.slice(start, length),
+            ])
+            records_filtered = df_filtered.item()
+        else:
+            df_page = df_sorted.slice(start, length).collect()
+            records_filtered = total_records
+    
+        # Prepare the response in DataTables format. Rows are serialized by polars directly
+        # (as a list of objects), without converting them to Python dicts first.
+        body = b'{"draw":%d,"recordsTotal":%d,"recordsFiltered":%d,"data":%s}' % (
+            draw, total_records, records_filtered, df_page.write_json().encode())
+    
+        return Response(body, mimetype='application/json')
 
 if __name__ == '__main__':
     app = Flask(__name__)
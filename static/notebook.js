@@ -1,15 +1,67 @@
 const socket = io();
 var lastScrolledTo = null
-socket.on('update', function(data) {
-    const contentElement = document.getElementById('content');
-    morphdom(contentElement, data, {childrenOnly: true});
-    
+const htmlDecoder = new TextDecoder('utf-8');
+
+function decodeHtml(data) {
+    // HTML is sent as UTF-8 bytes
+    return typeof data === 'string' ? data : htmlDecoder.decode(data);
+}
+
+function scrollToFocused() {
     let scrollTo = document.querySelector('.scroll-to')
     if (scrollTo && scrollTo !== lastScrolledTo) {
 	console.log('scroll', scrollTo)
     	scrollTo.scrollIntoView({behavior: 'smooth'});
 	lastScrolledTo = scrollTo;
     }
+}
+
+// cell_id -> version of the cell's HTML we have (versions are per server process)
+let knownVersions = {};
+let serverId = null;
+
+function cellsContainer() {
+    let container = document.getElementById('cells');
+    if (!container) {
+        document.getElementById('content').innerHTML = '<div><h1>Zima Notebook</h1><div id="cells"></div></div>';
+        container = document.getElementById('cells');
+    }
+    return container;
+}
+
+socket.on('cells', function(data) {
+    if (data.server !== serverId) {
+        serverId = data.server;
+        knownVersions = {};
+    }
+    const container = cellsContainer();
+    for (const [cellId, version, html] of data.cells) {
+        if (knownVersions[cellId] >= version)
+            continue;
+        const cellHtml = decodeHtml(html);
+        const cellElement = document.getElementById(`cell_${cellId}`);
+        if (cellElement) {
+            morphdom(cellElement, cellHtml);
+        } else {
+            const template = document.createElement('template');
+            template.innerHTML = cellHtml;
+            container.appendChild(template.content.firstElementChild);
+        }
+        knownVersions[cellId] = version;
+    }
+
+    // move the cells into the server's order, then drop the removed ones
+    data.order.forEach(function(cellId, i) {
+        const cellElement = document.getElementById(`cell_${cellId}`);
+        if (cellElement && container.children[i] !== cellElement)
+            container.insertBefore(cellElement, container.children[i] || null);
+    });
+    while (container.children.length > data.order.length) {
+        const removed = container.lastElementChild;
+        delete knownVersions[removed.id.slice('cell_'.length)];
+        removed.remove();
+    }
+    scrollToFocused();
 });
 
 let focusedCellId = null;
@@ -48,5 +100,5 @@ document.addEventListener('keydown', function(event) {
 });
 
 socket.on('connect', function() {
-    socket.emit('loaded', {});
+    socket.emit('loaded', {server: serverId, known: knownVersions});
 })
@@ -41,13 +41,30 @@ def load_token(config_dir):
             return f.read().strip()
     return None
 
+def _tokens_match(token, expected):
+    """
+    Constant time, so the token can't be guessed byte by byte from response timing.
+    (bytes are compared, `compare_digest` refuses non-ASCII str)
+
+    >>> _tokens_match('abc', 'abc')
+    True
+    >>> _tokens_match('é', 'abc')
+    False
+    >>> _tokens_match(None, 'abc')
+    False
+    """
+    return secrets.compare_digest((token or "").encode('utf8'), expected.encode('utf8'))
+
+def check_token(token):
+    return _tokens_match(token, app.config["API_TOKEN"])
+
 def token_required(f):
     @wraps(f)
     def decorated(*args, **kwargs):
         token = request.cookies.get('api_token')
         if not token:
             return redirect(url_for('login'))
-        if token != app.config["API_TOKEN"]:
+        if not check_token(token):
             return jsonify({"message": "Invalid token"}), 401
         return f(*args, **kwargs)
     return decorated
@@ -57,7 +74,7 @@ def _setup_routes(app, socketio):
     def login():
         if request.method == 'POST':
             token = request.form.get('token')
-            if token == app.config["API_TOKEN"]:
+            if check_token(token):
                 response = make_response(redirect('/'))
                 # AI-TODO: set cookie to forever. also make it HTTP only
                 response.set_cookie('api_token', token,
@@ -72,7 +89,7 @@ def _setup_routes(app, socketio):
         token = request.cookies.get('api_token')
         if not token:
             return False
-        if token != app.config["API_TOKEN"]:
+        if not check_token(token):
             return False
 
     
@@ -1,6 +1,11 @@
-from dataclasses import dataclass, replace
-from typing import Any, Optional, Protocol, TypedDict, Literal
-import hashlib, os, sys, itertools, functools, cloudpickle, contextlib, pickle, pathlib, shortuuid, shutil, json, base64, polars as pl, pandas as pd, re, tempfile, pyarrow as pa, pyarrow.parquet as pq, types, subprocess, threading, ast, sqlite3, argparse, duckdb, fcntl, logging, errno, string
+from dataclasses import dataclass, replace, field
+from typing import Any, Callable, Optional, Protocol, TypedDict, Literal, NotRequired
+import hashlib, os, sys, itertools, functools, contextlib, pickle, pathlib, secrets, shutil, json, base64, polars as pl, pandas as pd, re, tempfile, pyarrow as pa, pyarrow.parquet as pq, types, subprocess, threading, ast, sqlite3, argparse, duckdb, fcntl, logging, errno, string, concurrent.futures, mmap
+
+try:
+    import blake3
+except ImportError:
+    blake3 = None
 
 
 SCHEMA_SQL = '''
@@ -21,6 +26,7 @@ create table if not exists deps (
     dep_var_name text
 );
 create index if not exists idx_deps_var_name on deps (dep_var_name);
+create index if not exists idx_deps_cell_id on deps (cell_id);
 
 create table if not exists vars (
     owner_cell text,
@@ -84,7 +90,9 @@ class PythonDialect(Dialect):
         if '__all__' in locals:
             created_var_names = locals['__all__'] 
         else:
-            created_var_names = [ k for k in locals.keys() if not k.startswith('_') ]
+            # not e.g. imports, functions and loop variables
+            assigned = assigned_names(code)
+            created_var_names = [ k for k in locals.keys() if not k.startswith('_') and k in assigned ]
 
         created_vars = {}
         for name in created_var_names:
@@ -98,18 +106,78 @@ class PythonDialect(Dialect):
             created_vars=created_vars,
         )
 
+# builtins that give code access to variables it doesn't mention by name
+_DYNAMIC_LOOKUP_NAMES = frozenset(['globals', 'locals', 'vars', 'eval', 'exec'])
+
+@functools.lru_cache(maxsize=256)
+def referenced_names(code) -> Optional[frozenset[str]]:
+    '''
+    All names that Python code can look up (a superset of the variables `PythonDialect` may
+    load for it), None if that can't be told - the code doesn't parse or it may look up
+    variables by name at runtime.
+
+    >>> sorted(referenced_names('y = x + 1'))
+    ['x', 'y']
+    >>> referenced_names('y = globals()["x"]') is None
+    True
+    '''
+    try:
+        tree = ast.parse(code)
+    except SyntaxError:
+        return None
+    names = frozenset( node.id for node in ast.walk(tree) if isinstance(node, ast.Name) )
+    if names & _DYNAMIC_LOOKUP_NAMES:
+        return None
+    return names
+
+@functools.lru_cache(maxsize=256)
+def assigned_names(code) -> frozenset[str]:
+    '''
+    Names assigned to (=, += or annotated) at the top level of the code, including in
+    if/for/while/with/try/match blocks, but not in functions or classes.
+
+    >>> assigned_names('match 1:\\n    case 1:\\n        a = 2')
+    frozenset({'a'})
+    '''
+    names: set[str] = set()
+
+    def visit(stmts):
+        for stmt in stmts:
+            if isinstance(stmt, ast.Assign):
+                targets = stmt.targets
+            elif isinstance(stmt, (ast.AugAssign, ast.AnnAssign)):
+                targets = [stmt.target]
+            elif isinstance(stmt, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+                continue
+            else:
+                targets = []
+                # (`handlers` and `cases` hold except/case clauses, which have a `body`)
+                for name in ('body', 'orelse', 'finalbody', 'handlers', 'cases'):
+                    visit(getattr(stmt, name, []))
+
+            for target in targets:
+                names.update( node.id for node in ast.walk(target)
+                              if isinstance(node, ast.Name) and isinstance(node.ctx, ast.Store) )
+
+    visit(ast.parse(code).body)
+    return frozenset(names)
+
 @dataclass
 class NotebookDef:
     data_path: str
     preamble_python: str
     preamble_module: Any
     cells: dict[str, 'CellDef']
+    # cell text -> its parsed form, for reuse by the next `parse_notebook`
+    parsed_cells: dict[str, 'CellDef'] = field(default_factory=dict)
 
 @dataclass
 class ExecutorPayload:
-    preamble_module: str
+    # the executor rebuilds the preamble module and the dialect from source, so that
+    # the payload can use plain pickle
+    preamble_python: str
     code: str
-    dialect: Dialect
+    dialect_code: str
     vars: dict[str, str] # name to hash
     data_dir: pathlib.Path
     
@@ -181,12 +249,14 @@ def unparse_cell(cell: CellDef) -> str:
     
     return header + '\n' + cell.code + '\n'
     
+cell_id_regex = re.compile('[a-zA-Z0-9]+')
+
 def parse_cell(preamble_module, cell_text):
     cell_header, code = cell_text.split('\n', 1)
     splt = cell_header.split(None, 1)
     cell_id, cell_header = (splt + ['']) if len(splt) == 1 else splt
 
-    if not re.match("^[a-zA-Z0-9]+$", cell_id):
+    if not cell_id_regex.fullmatch(cell_id):
         raise ValueError("Invalid cell_id: Only alphanumeric characters are allowed. (%r)" % cell_id)
     
     code = code.strip()
@@ -202,29 +272,49 @@ def parse_cell(preamble_module, cell_text):
     return CellDef(id=cell_id, code=code, code_hash=code_hash,
                    args_code=raw_header, **header)    
     
-def parse_notebook(s, data_path) -> NotebookDef:
-    parts = s.split('\n#%cell ')
-    preamble_code = parts[0]
-    cell_texts = parts[1:]
+@functools.lru_cache(maxsize=8)
+def _compile_preamble(preamble_code):
+    return compile(preamble_code, '<preamble>', 'exec')
 
+def make_preamble_module(preamble_code):
     preamble_module: Any = types.ModuleType('notebook')
-    exec(preamble_code, preamble_module.__dict__)
+    exec(_compile_preamble(preamble_code), preamble_module.__dict__)
 
     preamble_module.PythonDialect = PythonDialect
+    return preamble_module
+
+def parse_notebook(s, data_path, previous: Optional[NotebookDef] = None) -> NotebookDef:
+    parts = s.split('\n#%cell ')
+    preamble_code = parts[0]
+    cell_texts = parts[1:]
+
+    if previous is not None and previous.preamble_python == preamble_code:
+        # Same preamble, so it's not executed again. Cell headers are evaluated in its
+        # namespace, so unchanged cells can be reused as well.
+        preamble_module = previous.preamble_module
+        previous_parsed_cells = previous.parsed_cells
+    else:
+        preamble_module = make_preamble_module(preamble_code)
+        previous_parsed_cells = {}
     
     cells = {}
+    parsed_cells = {}
     
     for cell_text in cell_texts:
-        cell = parse_cell(preamble_module, cell_text)
+        cell = previous_parsed_cells.get(cell_text)
+        if cell is None:
+            cell = parse_cell(preamble_module, cell_text)
         if cell.id in cells:
             raise Exception('duplicate cell %r' % cell.id)
         cells[cell.id] = cell
+        parsed_cells[cell_text] = cell
 
     return NotebookDef(
         data_path=data_path,
         preamble_python = preamble_code,
         preamble_module = preamble_module,
-        cells = cells
+        cells = cells,
+        parsed_cells = parsed_cells,
     )
         
 
@@ -248,6 +338,16 @@ def atomic_open_for_writing(path, mode='w'):
 
             raise
         
+# Variables are stored under the hash of their files. BLAKE3 is used if it's installed,
+# ZIMA_HASH=sha256 keeps the old hashes (e.g. to reuse variables in an existing data dir).
+USE_BLAKE3 = blake3 is not None and os.environ.get('ZIMA_HASH') != 'sha256'
+
+def _new_file_hasher(multithreaded=True):
+    if USE_BLAKE3:
+        return blake3.blake3(max_threads=blake3.blake3.AUTO if multithreaded else 1)
+    else:
+        return hashlib.sha256()
+
 def hash_file_or_dir(path):
     if os.path.islink(path):
         raise OSError('unexpected symlink')
@@ -256,24 +356,78 @@ def hash_file_or_dir(path):
     else:
         return hash_file(path)
 
-def hash_file(filename):
-    hasher = hashlib.sha256()
+def hash_file(filename, multithreaded=True):
+    hasher = _new_file_hasher(multithreaded)
     hasher.update(b'FILE\n')
-    chunk_size = 1024*1024
-    with open(filename, "rb") as f:
-        for chunk in iter(lambda: f.read(chunk_size), b""):
-            hasher.update(chunk)
+    if USE_BLAKE3:
+        hasher.update_mmap(filename)
+    else:
+        with open(filename, "rb") as f:
+            # (lets the kernel read further ahead)
+            if hasattr(os, 'posix_fadvise'):
+                os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+            if os.fstat(f.fileno()).st_size >= 10*1024*1024:
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                    if hasattr(mmap, 'MADV_SEQUENTIAL'):
+                        mm.madvise(mmap.MADV_SEQUENTIAL)
+                    hasher.update(mm)
+            else:
+                buf = bytearray(1024*1024)
+                view = memoryview(buf)
+                while n := f.readinto(buf):
+                    hasher.update(view[:n])
     return hasher.hexdigest()
 
-def hash_directory(directory : pathlib.Path):
-    hasher = hashlib.sha256()
+# (threads are only started once it's used)
+_hash_pool = concurrent.futures.ThreadPoolExecutor(max_workers=os.cpu_count(), thread_name_prefix='hash')
+
+def _hash_file_single_threaded(filename):
+    # the pool already uses all cores
+    return hash_file(filename, multithreaded=False)
+
+def hash_directory(directory : pathlib.Path, known_hashes: Optional[dict[str, str]] = None):
+    # Files of the whole tree are hashed in parallel first (hashers release the GIL), except
+    # those in `known_hashes` (path -> `hash_file` result, e.g. computed while writing the file).
+    directory = os.fspath(directory)
+    known_hashes = known_hashes or {}
+    files = [ os.path.join(root, name) for root, _dirs, names in os.walk(directory) for name in names ]
+    files = [ name for name in files if name not in known_hashes ]
+    if len(files) > 1:
+        file_hashes = dict(zip(files, _hash_pool.map(_hash_file_single_threaded, files)))
+    else:
+        file_hashes = { name: hash_file(name) for name in files }
+    file_hashes.update(known_hashes)
+
+    return _fold_directory(directory, file_hashes)
+
+class _HashingWriter:
+    # writes to `f`, hashing the data the same way as `hash_file`
+    def __init__(self, f):
+        self._f = f
+        self.hasher = _new_file_hasher()
+        self.hasher.update(b'FILE\n')
+
+    def write(self, data):
+        self.hasher.update(data)
+        return self._f.write(data)
+
+def _fold_directory(directory, file_hashes):
+    hasher = _new_file_hasher()
     hasher.update(b'DIR\n')
 
     children = os.listdir(directory)
     for name in sorted(children):
+        path = os.path.join(directory, name)
+        if os.path.islink(path):
+            raise OSError('unexpected symlink')
+        elif os.path.isdir(path):
+            child_hash = _fold_directory(path, file_hashes)
+        else:
+            child_hash = file_hashes[path]
+
         hasher.update(base64.b64encode(name.encode('utf8')))
         hasher.update(b'\n')
-        hasher.update(hash_file_or_dir(directory / name).encode())
+        hasher.update(child_hash.encode())
         hasher.update(b'\n')
 
     return hasher.hexdigest()
@@ -282,6 +436,8 @@ VarKindLiteral = Literal['pickle'] | Literal['parquet']
 
 class VarMeta(TypedDict):
     kind: VarKindLiteral
+    # number of out-of-band pickle buffers (data.pickle.buf0, ...), missing if none
+    buffers: NotRequired[int]
 
 def setup_duckdb(tempdir):
     d = duckdb.connect()
@@ -291,21 +447,68 @@ def setup_duckdb(tempdir):
 
 duckdb_invalid_table_regex = re.compile('^Catalog Error: Table with name ([^ ]+) does not exist$')
 
+duckdb_identifier_regex = re.compile(r'"(?:[^"]|"")*"|[^."]+')
+
+def _split_qualified_name(name):
+    '''
+    Parts of a (possibly quoted) qualified name, as returned by `get_table_names(qualified=True)`.
+
+    >>> _split_qualified_name('s."My ""Tbl"""')
+    ['s', 'My "Tbl"']
+    '''
+    return [ part[1:-1].replace('""', '"') if part.startswith('"') else part
+             for part in duckdb_identifier_regex.findall(name) ]
+
+def _missing_tables(d, query, namespace):
+    '''
+    Tables referenced by the query that are neither in the catalog nor in `namespace`.
+
+    >>> d = duckdb.connect()
+    >>> _ = d.execute('create table existing (x int)')
+    >>> sorted(_missing_tables(d, 'select * from "My Tbl", MixedCase, s.t, EXISTING, ns', {'ns': 1}))
+    ['MixedCase', 'My Tbl']
+    '''
+    try:
+        # (qualified, so that tables in other schemas can be told apart)
+        names = d.get_table_names(query, qualified=True)
+    except (duckdb.Error, AttributeError): # e.g. unparsable query, or an old DuckDB
+        return []
+    # (unquoted identifiers are case insensitive in DuckDB)
+    existing = { name.lower() for name, in d.execute('select table_name from information_schema.tables').fetchall() }
+    missing = []
+    for qualified_name in names:
+        parts = _split_qualified_name(qualified_name)
+        if len(parts) == 1 and parts[0].lower() not in existing and parts[0] not in namespace:
+            missing.append(parts[0])
+    return missing
+
 def execute_query_with_dynamic_tables(d, query, preamble_module, setup_table):
-    # it could be possible to do it via overriding globals with a custom object, but
-    # DuckDB calls PyDict_Contains directly, so instead we try to execute it and
+    # DuckDB lists the tables a query uses without executing it, so usually all of them
+    # can be set up upfront.
+    for name in _missing_tables(d, query, preamble_module.__dict__):
+        setup_table(d, name)
+
+    # Otherwise (it could be possible to do it via overriding globals with a custom object, but
+    # DuckDB calls PyDict_Contains directly) we try to execute it and
     # parse "table not found error" multiple times
     while True:
         try:
-            return eval('d.execute(query)', preamble_module.__dict__, {'query': query})
+            return eval('d.execute(query)', preamble_module.__dict__, {'d': d, 'query': query})
         except duckdb.CatalogException as err:
-            m = re.match(duckdb_invalid_table_regex, str(err))
+            m = duckdb_invalid_table_regex.match(str(err))
             if m:
                 name = m.group(1)
                 setup_table(d, name)
                 continue
             raise
         
+def _read_buffer(path):
+    # into a bytearray, so that e.g. numpy arrays loaded from it are writable
+    with open(path, 'rb') as f:
+        buf = bytearray(os.fstat(f.fileno()).st_size)
+        f.readinto(buf)
+    return buf
+
 class VarStorage:
     def __init__(self, dir : pathlib.Path):
         self.dir = dir
@@ -325,8 +528,9 @@ class VarStorage:
     def load_as_python(self, hash):
         path, var_meta = self.hash_meta(hash)
         if var_meta['kind'] == 'pickle':
+            buffers = [ _read_buffer(path / f'data.pickle.buf{i}') for i in range(var_meta.get('buffers', 0)) ]
             with open(path / 'data.pickle', 'rb') as f:
-                return pickle.load(f)
+                return pickle.load(f, buffers=buffers)
         elif var_meta['kind'] == 'parquet':
             return pl.scan_parquet(path / 'data.parquet', glob=False)
         else:
@@ -354,38 +558,55 @@ class VarStorage:
             raise Exception("not parquet variable")
         
     def write_python(self, data):
+        # vars are written (and hashed) often, so favour the write speed over the file size
         def writer_to_parquet():
             if isinstance(data, pa.Table):
-                return lambda output_path: pq.write_table(data, output_path)
+                return lambda output_path: pq.write_table(data, output_path, compression='zstd', compression_level=1)
             elif isinstance(data, pd.DataFrame):
-                return lambda output_path: data.to_parquet(output_path)
+                return lambda output_path: data.to_parquet(output_path, compression='zstd', compression_level=1)
             elif isinstance(data, pl.DataFrame):
-                return lambda output_path: data.write_parquet(output_path)
+                return lambda output_path: data.write_parquet(output_path, compression='zstd', compression_level=1,
+                                                              row_group_size=131072)
             elif  isinstance(data, pl.LazyFrame):
-                return lambda output_path: data.sink_parquet(output_path)
+                return lambda output_path: data.sink_parquet(output_path, compression='zstd', compression_level=1,
+                                                             row_group_size=131072)
 
 
         to_parquet = writer_to_parquet()
         result_hash = [None]
-        with self.with_dir(result_hash) as dir:
+        # (parquet files are written by the libraries, so they are hashed afterwards)
+        file_hashes: dict[str, str] = {}
+        with self.with_dir(result_hash, file_hashes) as dir:
             if to_parquet:
                 output_path = dir / "data.parquet"
                 to_parquet(output_path)
                 kind = 'parquet'
             else:
+                # large contiguous buffers (e.g. numpy arrays) are written to separate files as they are
+                buffers: list[pickle.PickleBuffer] = []
                 with open(dir / "data.pickle", 'wb') as f:
-                    pickle.dump(data, f)
+                    writer = _HashingWriter(f)
+                    pickle.dump(data, writer, protocol=5, buffer_callback=buffers.append)
+                file_hashes[str(dir / "data.pickle")] = writer.hasher.hexdigest()
+                for i, buf in enumerate(buffers):
+                    with open(dir / f"data.pickle.buf{i}", 'wb') as f:
+                        writer = _HashingWriter(f)
+                        writer.write(buf.raw())
+                    file_hashes[str(dir / f"data.pickle.buf{i}")] = writer.hasher.hexdigest()
 
                 (dir / "repr.txt").write_text(repr(data))
                 kind = 'pickle'
 
-            (dir / "meta.json").write_text(json.dumps({'kind': kind}))
+            meta: VarMeta = {'kind': kind}
+            if kind == 'pickle' and buffers:
+                meta['buffers'] = len(buffers)
+            (dir / "meta.json").write_text(json.dumps(meta))
 
         return result_hash[0]
                 
     @contextlib.contextmanager
-    def with_dir(self, put_hash_here):
-        loc = self.temp_dir / (shortuuid.uuid())
+    def with_dir(self, put_hash_here, file_hashes: Optional[dict[str, str]] = None):
+        loc = self.temp_dir / secrets.token_urlsafe(16)
         os.mkdir(loc)
         try:
             yield loc
@@ -393,7 +614,9 @@ class VarStorage:
             shutil.rmtree(loc)
             raise
 
-        hash = hash_file_or_dir(loc)
+        # Not cached: `loc` is always a freshly written directory, hashed exactly once here
+        # (`file_hashes` are the files the caller hashed while writing them).
+        hash = hash_directory(loc, file_hashes)
         put_hash_here[0] = hash
         path = self.hash_path(hash)
         try:
@@ -431,12 +654,22 @@ class Notebook:
         self._temp_dir.mkdir(exist_ok=True)
 
         self._pending_execution: dict[str, ExecutionState] = {}
+        # called (without arguments) after the notebook or the state of its cells changes
+        self.on_state_change: Optional[Callable[[], None]] = None
         self.var_storage = VarStorage(self._data_dir)
         
-        with self._db() as conn:
-            conn.executescript(SCHEMA_SQL)
-
         self._lock = threading.RLock()
+        # used from several threads, always under `self._lock` (via `_ro`/`_rw`)
+        self._conn = sqlite3.connect(self._data_dir / 'state.sqlite3',
+                                     isolation_level=None, check_same_thread=False)
+        self._conn.executescript('''
+            pragma journal_mode = WAL;
+            pragma synchronous = NORMAL;
+            pragma temp_store = MEMORY;
+            pragma mmap_size = 268435456;
+        ''')
+        self._conn.executescript(SCHEMA_SQL)
+
         self.reload_notebook()
 
     @_synchronized
@@ -468,30 +701,54 @@ class Notebook:
         
     @_synchronized
     def get_cell_state(self, cell_id) -> CellState:
-        with self._db() as conn:
+        with self._ro() as conn:
             row = conn.execute('''
                 SELECT preamble_hash, code_hash,dep_fresh 
                 FROM cell_state
                 WHERE id = ?
             ''', (cell_id,)).fetchone()
         
-        if row is None:
-            raise ValueError(f"Cell with id {cell_id} not found")
-        
-        preamble_hash, code_hash, dep_fresh = row
-        
-        current_log = self._logs_dir / f"{cell_id}.current.log"
-        pending_log = self._logs_dir / f"{cell_id}.pending.log"
-        
-        cell_def = self.notebook_def.cells[cell_id]
+            if row is None:
+                raise ValueError(f"Cell with id {cell_id} not found")
 
-        with self._db() as conn:
             var_hashes = dict(conn.execute('''
                 SELECT name, data_hash
                 FROM vars
                 WHERE owner_cell = ?
             ''', (cell_id,)).fetchall())
 
+        return self._make_cell_state(cell_id, row, var_hashes)
+
+    def snapshot_all_cell_state(self) -> dict[str, CellState]:
+        # the same as `get_cell_state` for every cell of the notebook, in one transaction
+        with self._ro() as conn:
+            rows = conn.execute('''
+                SELECT id, preamble_hash, code_hash, dep_fresh
+                FROM cell_state
+            ''').fetchall()
+            variables = conn.execute('''
+                SELECT owner_cell, name, data_hash
+                FROM vars
+            ''').fetchall()
+
+        var_hashes: dict[str, dict[str, str]] = {}
+        for owner_cell, name, data_hash in variables:
+            var_hashes.setdefault(owner_cell, {})[name] = data_hash
+
+        return {
+            cell_id: self._make_cell_state(cell_id, row, var_hashes.get(cell_id, {}))
+            for cell_id, *row in rows
+            if cell_id in self.notebook_def.cells
+        }
+
+    def _make_cell_state(self, cell_id, row, var_hashes) -> CellState:
+        preamble_hash, code_hash, dep_fresh = row
+        
+        current_log = self._logs_dir / f"{cell_id}.current.log"
+        pending_log = self._logs_dir / f"{cell_id}.pending.log"
+        
+        cell_def = self.notebook_def.cells[cell_id]
+
         return CellState(
             current_log=current_log,
             pending_log=pending_log,
@@ -502,7 +759,7 @@ class Notebook:
         )
 
     def get_var_hash(self, name):
-        with self._db() as conn:
+        with self._ro() as conn:
             row = conn.execute('''
                 SELECT data_hash 
                 FROM vars
@@ -516,25 +773,43 @@ class Notebook:
     
     def reload_notebook(self):
         content = self._notebook_path.read_text()
-        self.notebook_def = parse_notebook(content, self._data_dir)
+        self.notebook_def = parse_notebook(content, self._data_dir,
+                                           previous=getattr(self, 'notebook_def', None))
         self._preamble_hash = hash_string(self.notebook_def.preamble_python)
         self._reloaded_notebook_def()
+        self._state_changed()
+
+    def _state_changed(self):
+        if self.on_state_change is not None:
+            self.on_state_change()
+
+    def has_pending_execution(self):
+        return bool(self._pending_execution)
 
     def _lock_datadir(self):
         self._lock_fd = open(self._data_dir / "lock", 'w')
         fcntl.flock(self._lock_fd.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
         
     @contextlib.contextmanager
-    def _db(self):        
-        db = sqlite3.connect(self._data_dir / 'state.sqlite3')
-        db.execute('pragma journal_mode = WAL;');
-        db.cursor().execute('begin immediate;')
-        yield db.cursor()
-        db.commit()
+    def _transaction(self, begin):
+        with self._lock:
+            self._conn.execute(begin)
+            try:
+                yield self._conn.cursor()
+            except:
+                self._conn.execute('rollback;')
+                raise
+            self._conn.execute('commit;')
+
+    def _ro(self):
+        return self._transaction('begin;')
+
+    def _rw(self):
+        return self._transaction('begin immediate;')
 
     @_synchronized
     def _reloaded_notebook_def(self):
-        with self._db() as conn:                 
+        with self._rw() as conn:                 
             existing_cell_ids = [ id for id, in conn.execute('select id from cell_state').fetchall() ]
     
             for cell_id in existing_cell_ids - self.notebook_def.cells.keys():
@@ -549,7 +824,7 @@ class Notebook:
         if cell_id in self._pending_execution:
             raise Exception('cell already running %r' % cell_id)
         
-        temp_base_path = self._temp_dir / shortuuid.uuid()
+        temp_base_path = self._temp_dir / secrets.token_urlsafe(16)
         in_path = str(temp_base_path) + '.in'
         out_path = str(temp_base_path) + '.out'
 
@@ -559,20 +834,27 @@ class Notebook:
         log_file = self._logs_dir / (cell_id + '.pending.log')
         cell_def = self.notebook_def.cells[cell_id]
 
-        with self._db() as conn:
+        with self._ro() as conn:
             vars = dict(conn.execute('select name, data_hash from vars').fetchall())
 
+        if isinstance(cell_def.dialect, PythonDialect):
+            names = referenced_names(cell_def.code)
+            if names is not None:
+                vars = { name: hash for name, hash in vars.items() if name in names }
+
         executor_payload = ExecutorPayload(
-            preamble_module=self.notebook_def.preamble_module,
+            preamble_python=self.notebook_def.preamble_python,
             code=cell_def.code,
-            dialect=cell_def.dialect,
+            dialect_code=cell_def.args_code['dialect'],
             vars=vars,
             data_dir=self._data_dir,
         )
 
         with open(in_path, 'wb') as f:
-            cloudpickle.dump(executor_payload, f)
+            pickle.dump(executor_payload, f, protocol=5)
         
+        # (a new file, readers may have the previous log mapped - truncating it would break them)
+        log_file.unlink(missing_ok=True)
         with open(log_file, 'wb') as log_fd:
             proc = subprocess.Popen(
                 cmd,
@@ -588,6 +870,7 @@ class Notebook:
 
         t = threading.Thread(target=self._wait_for_execution, args=[cell_id, out_path])
         t.start()
+        self._state_changed()
         return t
 
     def _wait_for_execution(self, cell_id, out_path):
@@ -596,13 +879,13 @@ class Notebook:
         
         if exit_code == 0:
             with open(out_path, 'rb') as f:
-                result: ExecutorOutput = cloudpickle.load(f)
+                result: ExecutorOutput = pickle.load(f)
 
             with self._lock:
                 os.rename(self._logs_dir / (cell_id + '.pending.log'),
                           self._logs_dir / (cell_id + '.current.log'))
 
-                with self._db() as conn:
+                with self._rw() as conn:
                     self._set_vars(conn, cell_id, result.created_vars)
                     self._set_deps(conn, cell_id,
                                    state,
@@ -611,6 +894,7 @@ class Notebook:
             log('executor finished with non-zero exit code (cell_id = %s)', cell_id)
 
         del self._pending_execution[cell_id]
+        self._state_changed()
         
                 
     @_synchronized
@@ -621,7 +905,9 @@ class Notebook:
 
     @_synchronized
     def _set_deps(self, conn, cell_id, state: ExecutionState, new_deps):
-        current_vars = dict(conn.execute('select name, data_hash from vars').fetchall())
+        current_vars = dict(conn.execute(
+            'select name, data_hash from vars where name in (select value from json_each(?))',
+            (json.dumps(list(new_deps)),)).fetchall())
         dep_fresh = all( state.vars.get(dep) == current_vars.get(dep) for dep in new_deps )
         conn.execute('update cell_state set preamble_hash = ?, code_hash = ?, dep_fresh = ? where id = ?',
                      (self._preamble_hash, state.code_hash, dep_fresh, cell_id))
@@ -634,40 +920,45 @@ class Notebook:
 
     @_synchronized
     def _set_vars(self, conn, owner_cell, new_vars):
-        all_other_vars = set(
-            name for name, in 
-            conn.execute('select name from vars where owner_cell <> ?', (owner_cell,)).fetchall() )
-
-        if all_other_vars & new_vars.keys():
-            # this would anyway fail due to unique index
-            raise Exception('duplicate variable names with other cells: %s' % (all_other_vars & new_vars.keys()))
-        
         # new_vars is dict name -> hash
         old_vars = conn.execute('select name, data_hash from vars where owner_cell = ?', (owner_cell,)).fetchall()
         old_vars = dict(old_vars)
         
-        changes = [ (name,) for name in new_vars.keys() | old_vars.keys()
+        changes = [ name for name in new_vars.keys() | old_vars.keys()
                     if old_vars.get(name) != new_vars.get(name)]
     
         conn.execute('delete from vars where owner_cell = ?', (owner_cell,))
-        conn.executemany('insert into vars values (?, ?, ?)', [
-            (owner_cell, name, hash)
-            for name, hash in new_vars.items()
-        ])
-        conn.executemany('update cell_state set dep_fresh = false where id in (select cell_id from deps where dep_var_name = ?)', changes)
+        try:
+            conn.executemany('insert into vars values (?, ?, ?)', [
+                (owner_cell, name, hash)
+                for name, hash in new_vars.items()
+            ])
+        except sqlite3.IntegrityError as exc:
+            # unique index on name (the transaction is rolled back)
+            all_other_vars = set(
+                name for name, in 
+                conn.execute('select name from vars where owner_cell <> ?', (owner_cell,)).fetchall() )
+            raise Exception('duplicate variable names with other cells: %s' % (all_other_vars & new_vars.keys())) from exc
+
+        conn.execute('''
+            update cell_state set dep_fresh = false
+            where id in (select cell_id from deps where dep_var_name in (select value from json_each(?)))
+        ''', (json.dumps(changes),))
 
 def internal_execute(payload_file, output_file):
     with open(payload_file, 'rb') as f:
-        payload: ExecutorPayload = cloudpickle.load(f)
+        payload: ExecutorPayload = pickle.load(f)
     os.unlink(payload_file)
         
     var_storage = VarStorage(payload.data_dir)
+    preamble_module = make_preamble_module(payload.preamble_python)
+    dialect: Dialect = eval(payload.dialect_code, preamble_module.__dict__)
     
-    output = payload.dialect.execute(
-        payload.preamble_module,
+    output = dialect.execute(
+        preamble_module,
         payload.code,
         payload.vars,
         var_storage)
 
     with atomic_open_for_writing(output_file, 'wb') as f:
-        cloudpickle.dump(output, f)
+        pickle.dump(output, f, protocol=5)
@@ -1,142 +1,147 @@
 from zima_core import Notebook, VarMeta, CellState
-import pathlib, flask, lxml.html, lxml.builder, lxml.etree, urllib.parse
-import serve_table, zima_core, token_auth
-import os
-import subprocess
-from flask_socketio import SocketIO
+import pathlib, flask, html, urllib.parse
+import serve_table, token_auth, logtail
+import os, itertools, secrets, mmap, queue
+from flask_socketio import SocketIO, emit
 import threading
 import time
 import json
 from typing import Literal
 
-class _E:
-    def __getattr__(self, elem):
-        def elem_builder(*children, **kwargs):
-            real_children = []
-            
-            for ch in children:
-                if isinstance(ch, dict):
-                    kwargs.update(ch)
-                elif isinstance(ch, list):
-                    real_children += ch
-                else:
-                    real_children.append(ch)
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+class _OrjsonModule:
+    # the parts of the `json` module Socket.IO uses (it wants str and passes `separators`,
+    # orjson's output is compact anyway)
+    @staticmethod
+    def dumps(obj, **kwargs):
+        return orjson.dumps(obj).decode('utf8')
 
-            kwargs = {
-                k.replace('_', '-').rstrip('_'):v
-                for k, v in kwargs.items()
-                if v is not None
-            }
-            return getattr(lxml.builder.E, elem)(*real_children, **kwargs)
+    @staticmethod
+    def loads(s, **kwargs):
+        return orjson.loads(s)
 
-        return elem_builder
+def escape(text):
+    # for both text and (double quoted) attribute values
+    return html.escape(text, quote=True)
 
-E = _E()
+# (log_path, max_lines, max_line_length) -> (stat signature, content)
+_log_cache: dict[tuple, tuple[tuple, str]] = {}
 
 def read_log_file(log_path, max_lines=1000, max_line_length=1000):
-    if not os.path.exists(log_path):
+    try:
+        st = os.stat(log_path)
+    except FileNotFoundError:
         return None
+
+    # (inode is included, as logs are replaced by renaming)
+    signature = (st.st_ino, st.st_mtime_ns, st.st_size)
+    cache_key = (str(log_path), max_lines, max_line_length)
+    cached = _log_cache.get(cache_key)
+    if cached is not None and cached[0] == signature:
+        return cached[1]
     
     try:
-        result = subprocess.run(['tail', '-n', str(max_lines), log_path], capture_output=True, text=True)
-        log_content = result.stdout
-        
-        truncated_lines = [line[:max_line_length] for line in log_content.splitlines()]
-        return '\n'.join(truncated_lines)
+        with open(log_path, 'rb') as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                content = '' # (empty files can't be mapped)
+            else:
+                # only the lines that are kept are copied out of the file, the rest is just scanned
+                # (logs are never truncated in place, see `Notebook.execute_cell`)
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                    # (line lengths are counted in bytes)
+                    content = logtail.truncate_lines(data, max_lines, max_line_length).decode('utf8', errors='replace')
     except Exception as e:
         return f"Error reading log file: {str(e)}"
 
+    _log_cache[cache_key] = (signature, content)
+    return content
+
 def run_http_server(notebook, port):
     app = flask.Flask('zima')
-    socketio = SocketIO(app)
+    # (the notebook runs executions and waits for them on real threads, which would block
+    # the hub of eventlet/gevent without monkey patching)
+    socketio = SocketIO(app, async_mode='threading',
+                        json=_OrjsonModule if orjson is not None else json)
     token_auth.install(app, socketio, app_name='zima')
 
     def get_table_filename(args):
         hash = args['hash']
         return notebook.var_storage.get_var_parquet(hash)
         
-    serve_table.install(app, get_table_filename, decorator=token_auth.token_required)
+    serve_table.install(app, get_table_filename, decorator=token_auth.token_required,
+                        pure_get_filename=True)
     
+    # set whenever something shown to the clients might have changed
+    update_signal = threading.Event()
+
     # session vars
-    update_event = threading.Condition()
     mode: Literal['command'] | Literal['edit']  = 'command'
     current_cell_id = None
-    epoch = 0
     
     def _update():
-        nonlocal epoch
-        with update_event:
-            epoch += 1
-            update_event.notify_all()
+        update_signal.set()
             
-    def render_var(var):
-        meta: VarMeta = notebook.var_storage.get_var_meta(var[2])
+    def render_var(name, hash):
+        meta: VarMeta = notebook.var_storage.get_var_meta(hash)
 
         if meta['kind'] == 'parquet':
-            hash = notebook.get_var_hash(var[1])
-            content = getattr(E, 'data-table')(server_url='/data?hash=' + urllib.parse.quote(hash))
+            server_url = '/data?hash=' + urllib.parse.quote(hash)
+            content = f'<data-table server-url="{escape(server_url)}"></data-table>'
         else:
-            content = notebook.var_storage.get_var_repr(var[2])
+            content = escape(notebook.var_storage.get_var_repr(hash))
             
-        return E.div(
-            f"{var[1]} = ",
-            content,
-            class_="variable"
-        )
+        return f'<div class="variable">{escape(name)} = {content}</div>'
 
     def render_log(title: Literal['pending'] | Literal['current'], path):
         data = read_log_file(path)
         if data is None:
-            return E.div()
+            return '<div></div>'
         non_empty = data.strip()
-        log_content = E.pre(data) if non_empty else E.div()
+        log_content = f'<pre>{escape(data)}</pre>' if non_empty else '<div></div>'
         
         if title == 'pending':
-            return E.div('Pending', log_content)
+            return f'<div>Pending{log_content}</div>'
         else:
             return log_content
     
-    def render_cell(cell_id, cell, variables):
-        cell_state = notebook.get_cell_state(cell_id)
+    # cell_id -> modify-event and focus-event attributes (they only depend on the id)
+    cell_event_attrs: dict[str, str] = {}
 
+    def render_cell(cell_id, cell, cell_state, variables):
         freshness = [
             ('preamble', cell_state.preamble_fresh),
             ('code', cell_state.code_fresh),
             ('deps', cell_state.dep_fresh),
         ]
         stale = [ name for name, is_ in freshness if not is_ ]
-        freshness_html = E.div('stale', title=', '.join(stale)) if stale else 'fresh'
+        freshness_html = f'<div title="{escape(", ".join(stale))}">stale</div>' if stale else 'fresh'
 
         is_focused = cell_id == current_cell_id 
+        event_attrs = cell_event_attrs.get(cell_id)
+        if event_attrs is None:
+            modify_event = json.dumps({'name': 'save_code', 'params': {'cell_id': cell_id}})
+            focus_event = json.dumps({'name': 'focus_cell', 'params': {'cell_id': cell_id}})
+            event_attrs = cell_event_attrs[cell_id] = (
+                f' modify-event="{escape(modify_event)}" focus-event="{escape(focus_event)}"')
+        focus = ' focus="focus"' if is_focused and mode == 'edit' else ''
+        variables_html = ''.join( render_var(name, hash) for name, hash in variables )
 
-        return E.div(
-            E.div(E.span(f"Cell ID: {cell_id}", class_="cell-id")),
-            getattr(E, 'textarea-wrapper')(
-                text=cell.code,
-                id=f"code_{cell_id}",
-                modify_event=json.dumps({'name': 'save_code', 'params': {'cell_id': cell_id}}),
-                focus_event=json.dumps({'name': 'focus_cell', 'params': {'cell_id': cell_id}}),
-                focus='focus' if is_focused and mode == 'edit' else None),
-            E.div(
-                [render_var(var)
-                 for var in variables if var[0] == cell_id],
-                class_="variables"
-            ),
-            E.div(
-                E.div("Cell State:"),
-                freshness_html,
-                render_log('current', cell_state.current_log),
-                render_log('pending', cell_state.pending_log),
-                class_="cell-state"
-            ),
-            E.button(
-                "Run Cell",
-                class_="run-cell-button",
-                onclick=f"runCell('{cell_id}')"
-            ),
-            E.hr(),
-            id='cell_' + cell_id,
-            **{'class': 'cell focused scroll-to' if is_focused else 'cell'},
+        # (cell_id is alphanumeric, see `zima_core.parse_cell`)
+        return (
+            f'<div id="cell_{cell_id}" class="{"cell focused scroll-to" if is_focused else "cell"}">'
+            f'<div><span class="cell-id">Cell ID: {cell_id}</span></div>'
+            f'<textarea-wrapper text="{escape(cell.code)}" id="code_{cell_id}"{event_attrs}{focus}>'
+            f'</textarea-wrapper>'
+            f'<div class="variables">{variables_html}</div>'
+            f'<div class="cell-state"><div>Cell State:</div>{freshness_html}'
+            f'{render_log("current", cell_state.current_log)}{render_log("pending", cell_state.pending_log)}</div>'
+            f'<button class="run-cell-button" onclick="runCell(\'{cell_id}\')">Run Cell</button>'
+            f'<hr>'
+            f'</div>\n'
         )
     
     @app.route('/')
@@ -152,49 +157,148 @@ def run_http_server(notebook, port):
     def serve_static(filename):
         return flask.send_from_directory('static', filename)
     
+    def log_stat(path):
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            return None
+        return st.st_mtime_ns, st.st_size
+
+    # cell_id -> (everything the cell's HTML depends on, the HTML)
+    rendered_cells: dict[str, tuple[tuple, str]] = {}
+    # Every rendered HTML of a cell gets a new version. Clients tell which versions they
+    # have when they (re)connect and are sent only the cells that differ.
+    server_id = secrets.token_hex(8) # (versions of a previous server process mean nothing)
+    version_counter = itertools.count(1)
+    # cell_id -> (version, HTML)
+    cell_versions: dict[str, tuple[int, str]] = {}
+    cell_order: list[str] = []
+    versions_lock = threading.Lock()
+    # cells rendered, but not yet broadcast (None: nothing to send, otherwise at least the order)
+    unsent_cells: set[str] | None = None
+    # wakes `emit_updates` - holds at most one item, as it only needs to know that something changed
+    render_queue: queue.Queue[None] = queue.Queue(maxsize=1)
+    # (orders the emits, so that clients get the versions in order; taken before `versions_lock`)
+    emit_lock = threading.Lock()
+
+    def cells_message(cell_ids):
+        return {
+            'server': server_id,
+            'order': cell_order,
+            # (HTML is sent as binary attachments, which avoids JSON-escaping every quote)
+            'cells': [ [cell_id, cell_versions[cell_id][0], cell_versions[cell_id][1].encode('utf8')]
+                       for cell_id in cell_ids ],
+        }
+
     def render_notebook():
-        nonlocal current_cell_id
-        with notebook._db() as conn:
-            variables = conn.execute('SELECT owner_cell, name, data_hash FROM vars').fetchall()
+        """Returns HTML of all cells (in order), rendering only the ones that changed."""
+        nonlocal current_cell_id, rendered_cells
+        cell_states = notebook.snapshot_all_cell_state()
 
         if current_cell_id is None:
             cell_ids = list(notebook.notebook_def.cells.keys())
             if cell_ids:
                 current_cell_id = cell_ids[0] 
-            
-        var_storage = zima_core.VarStorage(notebook._data_dir)
-
-        html = E.div(
-            E.h1("Zima Notebook"),
-            [
-                render_cell(cell_id, cell, variables)
-                for cell_id, cell in notebook.notebook_def.cells.items()
-            ]
-        )
-        
-        return lxml.html.tostring(html, pretty_print=True).decode()
+
+        new_rendered_cells = {}
+        for cell_id, cell in notebook.notebook_def.cells.items():
+            cell_state = cell_states[cell_id]
+            cell_variables = tuple(cell_state.var_hashes.items())
+            is_focused = cell_id == current_cell_id
+            key = (cell.code,
+                   cell_state.preamble_fresh, cell_state.code_fresh, cell_state.dep_fresh,
+                   cell_variables,
+                   log_stat(cell_state.current_log), log_stat(cell_state.pending_log),
+                   is_focused, mode if is_focused else None)
+
+            cached = rendered_cells.get(cell_id)
+            if cached is not None and cached[0] == key:
+                cell_html = cached[1]
+            else:
+                cell_html = render_cell(cell_id, cell, cell_state, cell_variables)
+            new_rendered_cells[cell_id] = (key, cell_html)
+
+        rendered_cells = new_rendered_cells
+        return { cell_id: cell_html for cell_id, (_, cell_html) in new_rendered_cells.items() }
     
     def send_updates():
+        nonlocal cell_order, unsent_cells
+        while True:
+            # (cleared before rendering, so changes made while rendering wake the next wait)
+            update_signal.clear()
+            cells = render_notebook()
+            with versions_lock:
+                changed = [ cell_id for cell_id, cell_html in cells.items()
+                            if cell_id not in cell_versions or cell_versions[cell_id][1] != cell_html ]
+                for cell_id in changed:
+                    cell_versions[cell_id] = (next(version_counter), cells[cell_id])
+                for cell_id in cell_versions.keys() - cells.keys():
+                    del cell_versions[cell_id]
+
+                if changed or list(cells) != cell_order:
+                    cell_order = list(cells)
+                    unsent_cells = (unsent_cells or set()) | set(changed)
+                    try:
+                        render_queue.put_nowait(None)
+                    except queue.Full:
+                        pass # (the emitter hasn't woken up yet, it will send this too)
+            # notebook state changes call `_update`, only logs of running cells need to be polled
+            timeout = 1 if notebook.has_pending_execution() else None
+            update_signal.wait(timeout)
+
+    def emit_updates():
+        # (runs separately, so that rendering doesn't wait for slow clients)
+        nonlocal unsent_cells
         while True:
-            this_epoch = epoch
-            html_content = render_notebook()
-            socketio.emit('update', html_content)
-            with update_event:
-                update_event.wait_for(lambda: epoch != this_epoch, timeout=1)
+            render_queue.get()
+            with emit_lock:
+                with versions_lock:
+                    if unsent_cells is None:
+                        continue
+                    cell_ids = [ cell_id for cell_id in cell_order if cell_id in unsent_cells ]
+                    unsent_cells = None
+                    message = cells_message(cell_ids)
+                socketio.emit('cells', message)
+
+    # the client sends the code on every keystroke, it's saved once it stops changing for SAVE_DELAY
+    SAVE_DELAY = 0.1
+    # cell_id -> (latest code, timer that will save it)
+    pending_saves: dict[str, tuple[str, threading.Timer]] = {}
+    pending_saves_lock = threading.Lock()
+    # (keeps the saves in order)
+    save_lock = threading.Lock()
+
+    def flush_save(cell_id):
+        with save_lock:
+            with pending_saves_lock:
+                pending = pending_saves.pop(cell_id, None)
+            if pending is None:
+                return
+            new_code, timer = pending
+            timer.cancel()
+            notebook.modify_cell_code(cell_id, new_code)
+
+        socketio.emit('code_saved', {'cell_id': cell_id})
+        _update()
 
     @socketio.on('run_cell')
     def handle_run_cell(data):
         cell_id = data['cell_id']
+        flush_save(cell_id)
         notebook.execute_cell(cell_id)
 
     @socketio.on('save_code')
     def handle_save_code(data):
         cell_id = data['cell_id']
         new_code = data['content']
-        notebook.modify_cell_code(cell_id, new_code)
-        socketio.emit('code_saved', {'cell_id': cell_id})
-
-        _update()
+        with pending_saves_lock:
+            previous = pending_saves.get(cell_id)
+            if previous is not None:
+                previous[1].cancel()
+            timer = threading.Timer(SAVE_DELAY, flush_save, (cell_id,))
+            timer.daemon = True
+            pending_saves[cell_id] = (new_code, timer)
+            timer.start()
 
     @socketio.on('focus_cell')
     def handle_focus_cell(data):
@@ -207,8 +311,28 @@ def run_http_server(notebook, port):
     @socketio.on('loaded')
     def handle_loaded(data):
         print('loaded')
-        _update()
+        known = (data.get('known') or {}) if data.get('server') == server_id else {}
+        with emit_lock:
+            with versions_lock:
+                outdated = [ cell_id for cell_id in cell_order
+                             if known.get(cell_id) != cell_versions[cell_id][0] ]
+                message = cells_message(outdated)
+            emit('cells', message)
                 
+    # held arrow keys move the focus many times, only one update is sent per NAV_DELAY burst
+    NAV_DELAY = 0.03
+    nav_timer = None
+    nav_timer_lock = threading.Lock()
+
+    def _update_after_navigation():
+        nonlocal nav_timer
+        with nav_timer_lock:
+            if nav_timer is not None:
+                nav_timer.cancel()
+            nav_timer = threading.Timer(NAV_DELAY, _update)
+            nav_timer.daemon = True
+            nav_timer.start()
+
     @socketio.on('keydown')
     def handle_keydown(data):
         nonlocal current_cell_id, mode
@@ -225,8 +349,11 @@ def run_http_server(notebook, port):
                 if index >= 0 and index < len(cell_ids):
                     current_cell_id = cell_ids[index]
 
+            _update_after_navigation()
+            return
         
         if key == 'Ctrl+Enter':
+            flush_save(current_cell_id)
             notebook.execute_cell(current_cell_id)
                     
         if key == 'Enter' and mode == 'command':
@@ -237,8 +364,10 @@ def run_http_server(notebook, port):
                     
         _update()
                 
-    update_thread = threading.Thread(target=send_updates)
-    update_thread.daemon = True
-    update_thread.start()
+    notebook.on_state_change = _update
+
+    socketio.start_background_task(send_updates)
+    socketio.start_background_task(emit_updates)
 
-    app.run(port=port, debug=True, use_reloader=False)
+    # (a local, token protected server - hence Werkzeug is fine)
+    socketio.run(app, port=port, use_reloader=False, allow_unsafe_werkzeug=True)